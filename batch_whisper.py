@@ -4,23 +4,114 @@ import time
 import shutil
 import traceback
 import gc
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import queue
+import zlib
+import difflib
+import collections
+import dataclasses
+import json
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from faster_whisper import WhisperModel, BatchedInferencePipeline
 
 # ================= ❄️ RTX 5080 终极智能降级版 ❄️ =================
 # 模型路径
 MODEL_SIZE = "deepdml/faster-whisper-large-v3-turbo-ct2"
 
+DEVICE = "cuda"
+COMPUTE_TYPE = "float16"
+
+# 模型本地缓存目录 (None = HuggingFace 默认缓存)，子进程重启时直接从这里加载，不再联网检查
+MODEL_CACHE_DIR = None
+
+# 子进程回收：每个转写子进程处理 N 个文件、或内存/显存超标后换一个新进程，彻底释放泄漏
+WORKER_MAX_FILES = 8
+WORKER_MAX_RSS_MB = 12000
+WORKER_MAX_VRAM_MB = 14000
+WORKER_CRASH_RETRIES = 1    # 子进程崩溃时，这个文件在新进程上重试几次
+# 子进程卡死 (比如 CUDA 调用挂住) 的超时：音频时长 x 这个系数，且不少于最小值；读不到时长就用兜底值
+WORKER_TIMEOUT_RTF = 1.0
+WORKER_TIMEOUT_MIN = 900
+WORKER_TIMEOUT_FALLBACK = 4 * 3600
+WORKER_START_TIMEOUT = 600
+
 # 基础并发数 (Batch模式用)
 BATCH_SIZE = 12
 
 # 【功能开关】是否开启长句智能切分
 ENABLE_SMART_SPLIT = False
 MAX_CHARS_PER_LINE = 18
+# 长句词级对齐的批大小 (攒够这么多条需要切分的长句再一起 align)
+ALIGN_BATCH_SIZE = 16
+# 攒批也不能攒太久：待对齐的句子跨度超过这么多秒就先对齐输出，免得进度条和临时字幕停住
+ALIGN_MAX_PENDING_SECONDS = 60
+# 对齐窗口前后各多留一点音频，Whisper 的段尾时间戳经常切掉最后一个字的尾巴
+ALIGN_PAD_SECONDS = 0.5
+# 与 faster-whisper transcribe() 的默认值保持一致
+WORD_PREPEND_PUNCTUATIONS = "\"'“¿([{-"
+WORD_APPEND_PUNCTUATIONS = "\"'.。,，!！?？:：”)]}、"
+
+# 【功能开关】复读机检测：发现模型在同一句话里打转就掐掉，跳过这段音频继续
+ENABLE_LOOP_GUARD = True
+LOOP_WINDOW = 8                 # 循环的第一句要和最近多少句里的某句相似
+LOOP_SIMILARITY = 0.8           # 文本相似度超过这个算同一句话
+LOOP_LONG_LINE_CHARS = 30       # 只有这么长的单句才做下面两项"自我复读"检查
+LOOP_COMPRESSION_RATIO = 2.4    # 长句 zlib 压缩比超过这个算复读 (和 Whisper 自己的阈值一致)
+LOOP_NGRAM_REPEAT = 0.6         # 长句 3-gram 重复占比超过这个算复读
+LOOP_MIN_REPEATS = 5            # 连续这么多句都和第一句相似才判定为死循环
+LOOP_SKIP_SECONDS = 30          # 从循环结束处重新解码后又立刻进入循环，才往后跳这么多秒
 
 # 容错阈值：如果生成的时长比视频短了超过 60秒，触发降级
 TOLERANCE_SECONDS = 60
 MAX_RETRIES = 3
 
+INITIAL_PROMPT = "饼干岁们好，我是岁己。今天直播玩游戏，杂谈唱歌。哎呀，这个好难啊？没关系，我们可以的。请多关照。"
+
+# ASMR 专用宽松参数
+VAD_PARAMS = {
+    "min_silence_duration_ms": 3000,
+    "speech_pad_ms": 2000,
+    "threshold": 0.3
+}
+
+# 【功能开关】音频指纹去重：同一场直播的 flv/mp4/m4a 只转写一次
+ENABLE_FP_DEDUP = True
+FP_INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fp_index")
+FP_SAMPLE_RATE = 8000
+FP_FRAME = 2048          # 256ms 窗
+FP_HOP = 400             # 50ms 一帧指纹
+FP_BAND_EDGES = np.geomspace(300, 3000, 34)  # 33 个对数频带 -> 每帧 32 bit
+FP_MAX_BER = 0.3         # 误码率低于这个才算同一段音频 (无关音频约 0.5)
+FP_WINDOW_FRAMES = 200   # 按 10 秒一窗校验误码率，找出真正重合的片段
+FP_MIN_MATCH_SECONDS = 30
+FP_MIN_GAP_SECONDS = 5   # 比这短的未覆盖缝隙不单独转写
+FP_INDEX_STRIDE = 4      # 倒排表里每个已入库文件只收每 4 帧一个哈希 (0.2 秒)，查询端用全部帧
+FP_MAX_POSTINGS = 16     # 一个哈希在库里出现超过这么多次 (静音之类) 就不参与投票
+FP_MIN_VOTES = 10        # 同一 (文件, 偏移) 至少这么多票才拿去校验误码率
+FP_MAX_CANDIDATES = 5    # 每次最多校验票数最高的几个候选
+
+# 运行历史：每次转写都会追加一行，给 --plan / --deadline 估算耗时用
+RUN_HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".run_history.jsonl")
+STRATEGY_KEYS = {1: "batch", 2: "sequential", 3: "nuclear"}
+# 没有历史数据时的兜底：耗时/音频时长 (越小越快)，以及降级概率
+DEFAULT_RTF = {"fingerprint": 0.005, "probe": 0.01, "batch": 0.03, "sequential": 0.12, "nuclear": 0.15}
+DEFAULT_RETRY_RATE = 0.1
+
+# 【功能开关】预取：录播在 NAS 上时，提前把后面几个文件拉到本地临时目录再转写 (也可以用 --prefetch 打开)
+ENABLE_PREFETCH = False
+PREFETCH_DIR = os.path.join(tempfile.gettempdir(), "batch_whisper_scratch")
+PREFETCH_AHEAD = 2                      # 提前拉后面几个文件
+PREFETCH_MAX_BYTES = 20 * 1024 ** 3     # 临时目录最多占多少空间，超了按最久没用的先删
+PREFETCH_WORKERS = 2
+PREFETCH_AUDIO_ONLY = True              # 有 ffmpeg 就只抽音轨 (体积小得多)，没有就整文件复制
+PREFETCH_CHUNK = 16 * 1024 * 1024       # 大块顺序读，SMB 上比小块随机读快得多
+PREFETCH_AUDIO_KBPS = 320               # 抽音轨时读不到码率就按这个估算占多少空间
+
 VIDEO_EXTS = {'.mp4', '.flv', '.mkv', '.avi', '.mov', '.webm', '.ts', '.m4v', '.m4a'}
 
 
@@ -40,17 +131,61 @@ def format_timestamp(seconds):
     return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
 
 
+def parse_timestamp(text):
+    hms, ms = text.strip().split(",")
+    h, m, sec = hms.split(":")
+    return int(h) * 3600 + int(m) * 60 + int(sec) + int(ms) / 1000
+
+
+def read_srt(path):
+    lines = []
+    with open(path, "r", encoding="utf-8") as f:
+        blocks = f.read().strip().split("\n\n")
+    for block in blocks:
+        rows = block.strip().split("\n")
+        if len(rows) < 2 or "-->" not in rows[1]:
+            continue
+        start_s, end_s = rows[1].split("-->")
+        lines.append({"start": parse_timestamp(start_s), "end": parse_timestamp(end_s),
+                      "text": "\n".join(rows[2:])})
+    return lines
+
+
+def write_srt(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        for idx, line in enumerate(lines, start=1):
+            f.write(f"{idx}\n{format_timestamp(line['start'])} --> {format_timestamp(line['end'])}\n{line['text']}\n\n")
+
+
+def subtract_intervals(base, cuts):
+    """从区间 base=(start, end) 里挖掉 cuts，返回剩下的区间列表"""
+    remain = [base]
+    for c_start, c_end in cuts:
+        next_remain = []
+        for r_start, r_end in remain:
+            if c_end <= r_start or c_start >= r_end:
+                next_remain.append((r_start, r_end))
+                continue
+            if c_start > r_start: next_remain.append((r_start, c_start))
+            if c_end < r_end: next_remain.append((c_end, r_end))
+        remain = next_remain
+    return remain
+
+
 # --- ✂️ 智能切分算法 ✂️ ---
-def smart_split_segment(segment, max_chars=18):
-    if len(segment.text) <= max_chars or not segment.words:
+def smart_split_segment(segment, max_chars=18, words=None):
+    # words 由按需对齐阶段传入；没传就用 segment 自带的 (word_timestamps=True 的老路径)
+    if words is None:
+        words = segment.words
+    if len(segment.text) <= max_chars or not words:
         yield {"start": segment.start, "end": segment.end, "text": segment.text.strip()}
         return
 
     current_words = []
     current_len = 0
-    segment_start = segment.words[0].start
+    segment_start = words[0].start
 
-    for word in segment.words:
+    for word in words:
         word_text = word.word
         word_len = len(word_text)
         if current_len + word_len > max_chars and current_words:
@@ -67,15 +202,516 @@ def smart_split_segment(segment, max_chars=18):
                "text": "".join([w.word for w in current_words]).strip()}
 
 
-def transcribe_with_strategy(model, video_path, srt_path, total_duration):
+def needs_split(segment):
+    return len(segment.text) > MAX_CHARS_PER_LINE
+
+
+class SharedAudio:
+    """
+    一次转写尝试里共享的整段音频：第一次有人要才解码，之后按需对齐和复读跳过都用这一份，
+    几个小时的录播不会在内存里躺两份。
+    """
+
+    def __init__(self, source, sampling_rate):
+        self.source = source
+        self.sampling_rate = sampling_rate
+        self.audio = None
+
+    def get(self):
+        if self.audio is None:
+            # 指纹去重的补缺片段直接传进来的就是音频数组
+            if isinstance(self.source, np.ndarray):
+                self.audio = self.source
+            else:
+                from faster_whisper.audio import decode_audio
+                self.audio = decode_audio(self.source, sampling_rate=self.sampling_rate)
+        return self.audio
+
+
+# --- 🧲 按需词级对齐 🧲 ---
+class LazyWordAligner:
+    """
+    只给需要切分的长句补算词级时间戳。
+    转写阶段一律 word_timestamps=False，省掉每段都跑的 cross-attention 对齐；
+    长句攒成一批后：截取对应音频 -> 一次 encode -> 一次 align。
+    """
+
+    def __init__(self, model, shared_audio):
+        self.model = model
+        self.shared_audio = shared_audio
+        self.audio = None
+        self.tokenizer = None
+        self.broken = False
+
+    def _prepare(self):
+        if self.audio is not None:
+            return
+        # 只有真的遇到长句才去要整段音频 (和复读检测共用一份)
+        from faster_whisper.tokenizer import Tokenizer
+        self.audio = self.shared_audio.get()
+        self.tokenizer = Tokenizer(self.model.hf_tokenizer, self.model.model.is_multilingual,
+                                   task="transcribe", language="zh")
+
+    def align(self, segments):
+        """返回与 segments 一一对应的 Word 列表；对齐失败的位置为 None (该句不切分)"""
+        if not segments or self.broken:
+            return [None] * len(segments)
+        try:
+            return self._align_batch(segments)
+        except Exception as e:
+            # faster-whisper 内部接口变了就别硬来，整句输出不影响字幕正确性
+            print(f"\n   ⚠️  词级对齐失败，长句将不切分: {e}")
+            self.broken = True
+            return [None] * len(segments)
+
+    def _align_batch(self, segments):
+        from faster_whisper.audio import pad_or_trim
+        from faster_whisper.transcribe import Word, merge_punctuations
+
+        self._prepare()
+        fe = self.model.feature_extractor
+        sr = fe.sampling_rate
+        max_frames = fe.nb_max_frames
+
+        features, num_frames, text_tokens, offsets = [], [], [], []
+        audio_end = len(self.audio) / sr
+        for seg in segments:
+            start = max(0.0, seg.start - ALIGN_PAD_SECONDS)
+            end = min(seg.end + ALIGN_PAD_SECONDS, start + fe.chunk_length, audio_end)
+            chunk = self.audio[int(start * sr):int(end * sr)]
+            feat = fe(chunk)
+            num_frames.append(min(feat.shape[-1], max_frames))
+            features.append(pad_or_trim(feat))
+            text_tokens.append([t for t in seg.tokens if t < self.tokenizer.eot])
+            offsets.append(start)
+
+        encoder_output = self.model.encode(np.stack(features))
+        alignments = self.model.find_alignment(self.tokenizer, text_tokens, encoder_output, num_frames)
+
+        results = []
+        for seg, offset, words in zip(segments, offsets, alignments):
+            # 和 word_timestamps=True 的老路径一样把标点并进前后的词，不然"，"会单独成词、占字数
+            merge_punctuations(words, WORD_PREPEND_PUNCTUATIONS, WORD_APPEND_PUNCTUATIONS)
+            aligned = []
+            for w in words:
+                if not w["word"]:
+                    continue
+                w_start = min(max(offset + w["start"], seg.start), seg.end)
+                w_end = min(max(offset + w["end"], w_start), seg.end)
+                aligned.append(Word(start=round(w_start, 2), end=round(w_end, 2),
+                                    word=w["word"], probability=w["probability"]))
+            results.append(aligned or None)
+        return results
+
+
+def iter_aligned_segments(segments, aligner):
+    """
+    包一层 segment 生成器，产出 (segment, words)。
+    需要切分的长句攒够 ALIGN_BATCH_SIZE 条、或者攒了超过 ALIGN_MAX_PENDING_SECONDS 秒，
+    就一起对齐输出，顺序保持不变。
+    """
+    if aligner is None:
+        for seg in segments:
+            yield seg, None
+        return
+
+    pending = []
+    long_count = 0
+    for seg in segments:
+        if needs_split(seg):
+            long_count += 1
+        elif not pending:
+            # 前面没有在等对齐的长句，短句直接放行
+            yield seg, None
+            continue
+        pending.append(seg)
+        if long_count >= ALIGN_BATCH_SIZE or seg.end - pending[0].start >= ALIGN_MAX_PENDING_SECONDS:
+            yield from _flush_aligned(pending, aligner)
+            pending = []
+            long_count = 0
+    if pending:
+        yield from _flush_aligned(pending, aligner)
+
+
+def _flush_aligned(pending, aligner):
+    long_segs = [s for s in pending if needs_split(s)]
+    aligned = iter(aligner.align(long_segs))
+    for seg in pending:
+        yield seg, (next(aligned) if needs_split(seg) else None)
+
+
+def run_transcribe(model, video_path, use_batch, use_vad, word_timestamps=False):
+    """按策略发起一次转写，返回 (segments 生成器, batched_model)"""
+    if use_batch:
+        # 策略1：Batch Pipeline
+        batched_model = BatchedInferencePipeline(model=model)
+        segments, _ = batched_model.transcribe(
+            video_path,
+            batch_size=BATCH_SIZE,
+            language="zh",
+            initial_prompt=INITIAL_PROMPT,
+            vad_filter=True,
+            vad_parameters=VAD_PARAMS,
+            word_timestamps=word_timestamps
+        )
+        return segments, batched_model
+
+    # 策略2 & 3：原生串行模式 (不经过 Pipeline)
+    segments, _ = model.transcribe(
+        video_path,
+        beam_size=5,
+        language="zh",
+        initial_prompt=INITIAL_PROMPT,
+        vad_filter=use_vad,
+        vad_parameters=VAD_PARAMS if use_vad else None,
+        word_timestamps=word_timestamps,
+        condition_on_previous_text=False
+    )
+    return segments, None
+
+
+# --- 🔁 复读机检测 🔁 ---
+def compression_ratio(text):
+    data = text.encode("utf-8")
+    return len(data) / len(zlib.compress(data))
+
+
+def ngram_repeat_ratio(text, n=3):
+    grams = [text[i:i + n] for i in range(len(text) - n + 1)]
+    if len(grams) < 4:
+        return 0.0
+    return 1 - len(set(grams)) / len(grams)
+
+
+def shift_segment(segment, offset):
+    """把从音频切片里解出来的 segment 平移回原时间轴"""
+    if not offset:
+        return segment
+    if dataclasses.is_dataclass(segment):
+        return dataclasses.replace(segment, start=segment.start + offset, end=segment.end + offset)
+    return segment._replace(start=segment.start + offset, end=segment.end + offset)
+
+
+class RepetitionGuard:
+    """
+    套在 segment 生成器外面的复读检测。
+    一句话和最近几句里的某句相似 (或者是一条自我复读的长句)，就从它开始扣住不输出；
+    后面的句子只要和扣住的第一句相似就继续扣，凑满 LOOP_MIN_REPEATS 句判定为死循环：
+    丢掉扣住的句子，关掉生成器，从循环最后一句的结尾重新解码。
+    如果重新解码后马上又进了循环，说明这段音频本身就会让模型打转，这次才往后跳 LOOP_SKIP_SECONDS 秒。
+    """
+
+    def __init__(self, shared_audio, restart, total_duration):
+        self.shared_audio = shared_audio
+        self.restart = restart
+        self.total_duration = total_duration
+        self.suppressed = []    # 解码过但被丢弃的复读区间
+        self.skipped = []       # 跳过没解码的区间
+
+    @property
+    def covered_until(self):
+        """真正解码过的最远位置 (跳过的区间不算)"""
+        return max((end for _, end in self.suppressed), default=0)
+
+    @staticmethod
+    def _similar(a, b):
+        return difflib.SequenceMatcher(None, a, b).ratio() >= LOOP_SIMILARITY
+
+    def _starts_loop(self, text, recent):
+        if not text:
+            return False
+        if any(self._similar(text, prev) for prev in recent):
+            return True
+        if len(text) < LOOP_LONG_LINE_CHARS:
+            return False
+        return compression_ratio(text) > LOOP_COMPRESSION_RATIO or ngram_repeat_ratio(text) > LOOP_NGRAM_REPEAT
+
+    def _audio_from(self, start):
+        return self.shared_audio.get()[int(start * self.shared_audio.sampling_rate):]
+
+    def wrap(self, segments):
+        offset = 0.0
+        last_resume = None
+        recent = collections.deque(maxlen=LOOP_WINDOW)
+        while segments is not None:
+            held = []
+            looped = False
+
+            for segment in segments:
+                segment = shift_segment(segment, offset)
+                text = segment.text.strip()
+                if held and text and self._similar(text, held[0].text.strip()):
+                    held.append(segment)
+                    if len(held) >= LOOP_MIN_REPEATS:
+                        looped = True
+                        break
+                    continue
+
+                # 扣住的几句没凑够循环，原样放出去，再单独看这一句
+                yield from held
+                recent.extend(h.text.strip() for h in held)
+                held = []
+                if self._starts_loop(text, recent):
+                    held.append(segment)
+                    continue
+                recent.append(text)
+                yield segment
+
+            if not looped:
+                # 正常结束：扣住的尾巴没凑够循环次数，照常输出
+                yield from held
+                return
+
+            if hasattr(segments, "close"): segments.close()
+            loop_start, loop_end = held[0].start, held[-1].end
+            # 记住循环的内容：重新解码后第一句又是它的话能立刻扣住
+            recent.append(held[0].text.strip())
+            self.suppressed.append((loop_start, loop_end))
+            resume = loop_end
+            if last_resume is not None and loop_start - last_resume < LOOP_SKIP_SECONDS:
+                # 刚从这里重新开始就又复读了，这段音频跳过不解码
+                resume = min(loop_end + LOOP_SKIP_SECONDS, self.total_duration)
+                self.skipped.append((loop_end, resume))
+            print(f"\n   🔁 检测到复读循环 [{format_timestamp(loop_start)} -> {format_timestamp(loop_end)}]，"
+                  f"丢弃 {len(held)} 句，从 {format_timestamp(resume)} 继续...")
+
+            offset = resume
+            last_resume = resume
+            segments = None
+            if resume < self.total_duration - 1:
+                segments = self.restart(self._audio_from(resume))
+
+    def report(self):
+        if not self.suppressed:
+            return
+        total = sum(end - start for start, end in self.suppressed)
+        print(f"   🔁 共丢弃 {len(self.suppressed)} 处复读 (合计 {total:.1f}s):")
+        for start, end in self.suppressed:
+            print(f"      {format_timestamp(start)} -> {format_timestamp(end)}")
+        for start, end in self.skipped:
+            print(f"   ⏭️  未解码跳过: {format_timestamp(start)} -> {format_timestamp(end)}")
+
+
+# --- 🧬 音频指纹去重 🧬 ---
+def compute_fingerprint(audio):
+    """
+    Haitsma-Kalker 风格的子指纹：每 50ms 一个 32bit 哈希，
+    bit = 相邻频带能量差在时间方向上的变化符号。对重新封装/转码都很稳。
+    """
+    n_bands = len(FP_BAND_EDGES) - 1
+    if len(audio) < FP_FRAME * 2:
+        return np.zeros(0, dtype=np.uint32)
+
+    window = np.hanning(FP_FRAME).astype(np.float32)
+    freqs = np.fft.rfftfreq(FP_FRAME, 1 / FP_SAMPLE_RATE)
+    bounds = np.searchsorted(freqs, FP_BAND_EDGES)
+    n_frames = 1 + (len(audio) - FP_FRAME) // FP_HOP
+    energies = np.empty((n_frames, n_bands), dtype=np.float32)
+
+    # 分块做 STFT，几个小时的录播也不会一次性吃掉几个 G 内存
+    block = 2000
+    offsets = np.arange(FP_FRAME)
+    for start in range(0, n_frames, block):
+        end = min(n_frames, start + block)
+        idx = np.arange(start, end)[:, None] * FP_HOP + offsets
+        spec = np.abs(np.fft.rfft(audio[idx] * window, axis=1)) ** 2
+        energies[start:end] = np.add.reduceat(spec[:, :bounds[-1]], bounds[:-1], axis=1)
+
+    band_diff = energies[:, :-1] - energies[:, 1:]
+    bits = (band_diff[1:] - band_diff[:-1]) > 0
+    weights = (1 << np.arange(n_bands - 1, dtype=np.uint64))
+    return (bits * weights).sum(axis=1).astype(np.uint32)
+
+
+def match_runs(fp_a, fp_b, offset):
+    """
+    在给定偏移下按窗口算误码率，连续达标的窗口才算真正重合。
+    a 的第 i 帧对应 b 的第 i + offset 帧；返回 a 坐标系下的 [(a_lo, a_hi), ...]。
+    """
+    min_frames = int(FP_MIN_MATCH_SECONDS * FP_SAMPLE_RATE / FP_HOP)
+    a_lo = max(0, -offset)
+    a_hi = min(len(fp_a), len(fp_b) - offset)
+    runs = []
+    run_start = None
+    for w_start in range(a_lo, a_hi, FP_WINDOW_FRAMES):
+        w_end = min(a_hi, w_start + FP_WINDOW_FRAMES)
+        diff = np.bitwise_xor(fp_a[w_start:w_end], fp_b[w_start + offset:w_end + offset])
+        ber = np.unpackbits(diff.view(np.uint8)).mean()
+        if ber <= FP_MAX_BER:
+            if run_start is None: run_start = w_start
+            run_end = w_end
+        elif run_start is not None:
+            runs.append((run_start, run_end))
+            run_start = None
+    if run_start is not None:
+        runs.append((run_start, run_end))
+    return [(lo, hi) for lo, hi in runs if hi - lo >= min_frames]
+
+
+class FingerprintIndex:
+    """
+    本地指纹库 (FP_INDEX_DIR)：
+    index.json 记录每个已转写文件的大小/修改时间/时长，
+    <id>.npy 存指纹，<id>.srt 存一份字幕副本 (原字幕被挪走也不影响复用)。
+    内存里只留一张按哈希排好序的倒排表 (哈希 -> 文件, 帧号)，
+    查询时一次投票选出候选，只把票数最高的几个文件的完整指纹从磁盘读出来校验。
+    """
+
+    def __init__(self, root=FP_INDEX_DIR):
+        self.root = root
+        self.index_path = os.path.join(root, "index.json")
+        self.entries = {}
+        self._table = None
+        os.makedirs(root, exist_ok=True)
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f"⚠️  指纹库损坏，重新建库: {e}")
+
+    def _save(self):
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.index_path)
+
+    @staticmethod
+    def _key(path):
+        return hashlib.md5(os.path.abspath(path).encode("utf-8")).hexdigest()
+
+    def fingerprint(self, path, source=None):
+        """返回 (指纹, 时长秒)；文件没变过就直接用库里的。source 是实际读取的文件 (预取的本地副本)"""
+        entry = self.entries.get(self._key(path))
+        stat = os.stat(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            fp = self._load_fp(entry["id"])
+            if fp is not None:
+                return fp, entry["duration"]
+
+        from faster_whisper.audio import decode_audio
+        fp_start = time.time()
+        audio = decode_audio(source or path, sampling_rate=FP_SAMPLE_RATE)
+        fp = compute_fingerprint(audio)
+        duration = len(audio) / FP_SAMPLE_RATE
+        record_history("fingerprint", os.path.splitext(path)[1].lower(), duration, time.time() - fp_start, "ok")
+        return fp, duration
+
+    def _load_fp(self, key, mmap=False):
+        fp_path = os.path.join(self.root, key + ".npy")
+        if not os.path.exists(fp_path):
+            return None
+        return np.load(fp_path, mmap_mode="r" if mmap else None)
+
+    def _ensure_table(self):
+        """第一次查询时从磁盘建倒排表；之后入库只往里追加"""
+        if self._table is not None:
+            return
+        self._table = {"ids": [], "hashes": np.zeros(0, np.uint32),
+                       "owners": np.zeros(0, np.uint32), "frames": np.zeros(0, np.uint32)}
+        parts = []
+        for key in self.entries:
+            fp = self._load_fp(key, mmap=True)
+            if fp is not None:
+                parts.append((key, np.array(fp[::FP_INDEX_STRIDE])))
+        self._add_to_table(parts)
+
+    def _add_to_table(self, parts):
+        """parts: [(key, 抽样后的哈希)]"""
+        if not parts:
+            return
+        table = self._table
+        hashes, owners, frames = [table["hashes"]], [table["owners"]], [table["frames"]]
+        for key, sampled in parts:
+            if key in table["ids"]:
+                # 同一文件重新入库：旧的倒排项留着也无妨，校验时读的是磁盘上最新的指纹
+                owner = table["ids"].index(key)
+            else:
+                owner = len(table["ids"])
+                table["ids"].append(key)
+            hashes.append(sampled)
+            owners.append(np.full(len(sampled), owner, dtype=np.uint32))
+            frames.append(np.arange(len(sampled), dtype=np.uint32) * FP_INDEX_STRIDE)
+        hashes = np.concatenate(hashes)
+        order = np.argsort(hashes, kind="stable")
+        table["hashes"] = hashes[order]
+        table["owners"] = np.concatenate(owners)[order]
+        table["frames"] = np.concatenate(frames)[order]
+
+    def _vote(self, fp, exclude):
+        """
+        查询指纹的每一帧去倒排表里找同样的哈希，按 (文件, 时间偏移) 计票。
+        返回票数最高的候选 [(key, offset_frames)]，每个文件只取最佳偏移。
+        """
+        table = self._table
+        left = np.searchsorted(table["hashes"], fp, "left")
+        counts = np.searchsorted(table["hashes"], fp, "right") - left
+        # 只用出现次数少的哈希，静音这类烂大街的不算
+        query = np.nonzero((counts > 0) & (counts <= FP_MAX_POSTINGS))[0]
+        if len(query) == 0:
+            return []
+        reps = counts[query]
+        postings = np.repeat(left[query], reps) + (np.arange(reps.sum()) - np.repeat(np.cumsum(reps) - reps, reps))
+        owners = table["owners"][postings].astype(np.int64)
+        offsets = table["frames"][postings].astype(np.int64) - np.repeat(query, reps)
+
+        keys, votes = np.unique((owners << 32) | (offsets + (1 << 31)), return_counts=True)
+        best = {}
+        for packed, n in zip(keys[np.argsort(-votes)], np.sort(votes)[::-1]):
+            if n < FP_MIN_VOTES or len(best) >= FP_MAX_CANDIDATES:
+                break
+            owner = int(packed >> 32)
+            if owner in best or table["ids"][owner] == exclude:
+                continue
+            best[owner] = int(packed & 0xFFFFFFFF) - (1 << 31)
+        return [(table["ids"][owner], offset) for owner, offset in best.items()]
+
+    def find_coverage(self, fp, path):
+        """
+        找出库里能覆盖 fp 的片段，贪心挑最长的、互不重叠。
+        返回 [(start, end, srt副本路径, offset秒)]，时间都在当前文件的时间轴上。
+        """
+        min_frames = int(FP_MIN_MATCH_SECONDS * FP_SAMPLE_RATE / FP_HOP)
+        if len(fp) < min_frames:
+            return []
+        self._ensure_table()
+        frame_sec = FP_HOP / FP_SAMPLE_RATE
+        candidates = []
+        for key, offset in self._vote(fp, self._key(path)):
+            srt_copy = os.path.join(self.root, key + ".srt")
+            other = self._load_fp(key, mmap=True)
+            if key not in self.entries or other is None or not os.path.exists(srt_copy):
+                continue
+            for lo, hi in match_runs(fp, other, offset):
+                candidates.append((lo * frame_sec, hi * frame_sec, srt_copy, offset * frame_sec))
+
+        pieces = []
+        for start, end, srt_copy, offset in sorted(candidates, key=lambda c: c[0] - c[1]):
+            for r_start, r_end in subtract_intervals((start, end), [(p[0], p[1]) for p in pieces]):
+                if r_end - r_start >= FP_MIN_GAP_SECONDS:
+                    pieces.append((r_start, r_end, srt_copy, offset))
+        return sorted(pieces)
+
+    def register(self, path, fp, duration, srt_path):
+        key = self._key(path)
+        stat = os.stat(path)
+        np.save(os.path.join(self.root, key + ".npy"), fp)
+        shutil.copyfile(srt_path, os.path.join(self.root, key + ".srt"))
+        self.entries[key] = {"id": key, "path": os.path.abspath(path), "size": stat.st_size,
+                             "mtime": stat.st_mtime, "duration": duration}
+        self._save()
+        if self._table is not None:
+            self._add_to_table([(key, fp[::FP_INDEX_STRIDE])])
+
+
+def transcribe_with_strategy(model, video_path, srt_path, total_duration, source_ext=""):
     """
     三级火箭策略：
     1. Batch模式: 极速，但 ASMR 容易丢包
     2. Sequential模式: 稍慢，但极度稳定，死磕到底
     3. 核弹模式: 关闭 VAD，强行转写每一秒
+    返回 True 表示拿到了完整字幕；策略耗尽只保留残缺结果、或者全部出错时返回 False。
     """
-    prompt = "饼干岁们好，我是岁己。今天直播玩游戏，杂谈唱歌。哎呀，这个好难啊？没关系，我们可以的。请多关照。"
-
     # 临时文件，防止写坏正式文件
     temp_srt = srt_path + ".tmp"
 
@@ -95,57 +731,38 @@ def transcribe_with_strategy(model, video_path, srt_path, total_duration):
 
         print(f"\n👉 第 {attempt} 次尝试: 启用 {strategy_name}...")
 
-        # ASMR 专用宽松参数
-        vad_params = {
-            "min_silence_duration_ms": 3000,
-            "speech_pad_ms": 2000,
-            "threshold": 0.3
-        }
-
+        strategy_key = STRATEGY_KEYS[attempt]
         start_time = time.time()
         last_segment_end = 0
         line_count = 0
 
         try:
-            segments = None
-            batched_model = None
-
-            if use_batch:
-                # 策略1：Batch Pipeline
-                batched_model = BatchedInferencePipeline(model=model)
-                segments, _ = batched_model.transcribe(
-                    video_path,
-                    batch_size=BATCH_SIZE,
-                    language="zh",
-                    initial_prompt=prompt,
-                    vad_filter=True,
-                    vad_parameters=vad_params,
-                    word_timestamps=True
-                )
-            else:
-                # 策略2 & 3：原生串行模式 (不经过 Pipeline)
-                segments, _ = model.transcribe(
-                    video_path,
-                    beam_size=5,
-                    language="zh",
-                    initial_prompt=prompt,
-                    vad_filter=use_vad,
-                    vad_parameters=vad_params if use_vad else None,
-                    word_timestamps=True,
-                    condition_on_previous_text=False
-                )
+            segments, batched_model = run_transcribe(model, video_path, use_batch, use_vad)
+
+            # 整段音频这次尝试里最多解码一次，对齐器和复读检测共用
+            shared_audio = SharedAudio(video_path, model.feature_extractor.sampling_rate)
+
+            guard = None
+            if ENABLE_LOOP_GUARD:
+                guard = RepetitionGuard(shared_audio,
+                                        lambda audio: run_transcribe(model, audio, use_batch, use_vad)[0],
+                                        total_duration)
+                segments = guard.wrap(segments)
 
             # 进度条
             term_width = shutil.get_terminal_size().columns
             bar_width = max(20, term_width - 65)
 
+            # 词级时间戳按需计算：只有开了智能切分才需要对齐器
+            aligner = LazyWordAligner(model, shared_audio) if ENABLE_SMART_SPLIT else None
+
             with open(temp_srt, "w", encoding="utf-8") as f:
-                for raw_segment in segments:
+                for raw_segment, words in iter_aligned_segments(segments, aligner):
                     last_segment_end = raw_segment.end
 
                     # 切分逻辑
                     if ENABLE_SMART_SPLIT:
-                        sub_segments = smart_split_segment(raw_segment, MAX_CHARS_PER_LINE)
+                        sub_segments = smart_split_segment(raw_segment, MAX_CHARS_PER_LINE, words)
                     else:
                         sub_segments = [{
                             "start": raw_segment.start, "end": raw_segment.end, "text": raw_segment.text.strip()
@@ -177,11 +794,16 @@ def transcribe_with_strategy(model, video_path, srt_path, total_duration):
             print()
 
             # === 🛡️ 完整性检查 ===
+            # 解码过但被丢弃的复读区间也算处理过了，不然会被误判成丢包去换更慢的策略
+            if guard:
+                guard.report()
+                last_segment_end = max(last_segment_end, guard.covered_until)
             missing = total_duration - last_segment_end
 
             # 只有当缺失严重，且视频本身不是特别短
             if missing > TOLERANCE_SECONDS and total_duration > 120:
                 print(f"   ⚠️  警告: 缺失 {missing:.1f} 秒 (总长 {format_timestamp(total_duration)})")
+                record_history(strategy_key, source_ext, total_duration, time.time() - start_time, "short")
 
                 if attempt < MAX_RETRIES:
                     print(f"   🚫 当前策略不适合此视频 (ASMR音量过低)，准备切换策略重试...")
@@ -189,24 +811,645 @@ def transcribe_with_strategy(model, video_path, srt_path, total_duration):
                     continue  # 触发下一次循环(换策略)
                 else:
                     print(f"   💀 所有策略耗尽，保留现有结果。")
+                    complete = False
+            else:
+                complete = True
 
             # 成功：移动临时文件到目标路径
             if os.path.exists(srt_path): os.remove(srt_path)
             os.rename(temp_srt, srt_path)
             print(f"   ✅ 成功生成！耗时: {time.time() - start_time:.1f}s")
+            if complete:
+                record_history(strategy_key, source_ext, total_duration, time.time() - start_time, "ok")
 
             # 清理内存
             if batched_model: del batched_model
             gc.collect()
-            return
+            return complete
 
         except Exception as e:
             print(f"\n   ❌ 出错: {e}")
             traceback.print_exc()
+            record_history(strategy_key, source_ext, total_duration, time.time() - start_time, "error")
             time.sleep(2)
 
+    return False
+
 
-def process_one_video(model, video_path, file_idx, total_files):
+def transcribe_with_reuse(model, video_path, srt_path, total_duration, pieces):
+    """
+    指纹命中时的转写：覆盖到的部分直接平移已有字幕，只转写没覆盖的缝隙。
+    返回 True 表示字幕完整 (可以反过来登记进指纹库)。
+    """
+    lines = []
+    for start, end, srt_copy, offset in pieces:
+        # 片段开头如果紧挨着另一个复用片段，跨界的那句已经由前一段收了，不能重复
+        joined = any(p[1] == start for p in pieces)
+        for line in read_srt(srt_copy):
+            line_start = line["start"] - offset
+            line_end = line["end"] - offset
+            if line_start < start and joined:
+                continue
+            # 剪在半句话上的片段：开头那句跨过边界也要保留，起点截到片段边界
+            if line_end > start and line_start < end:
+                lines.append({"start": max(line_start, start), "end": min(line_end, end), "text": line["text"]})
+
+    covered = [(p[0], p[1]) for p in pieces]
+    gaps = [(g_start, g_end) for g_start, g_end in subtract_intervals((0, total_duration), covered)
+            if g_end - g_start >= FP_MIN_GAP_SECONDS]
+    reused = sum(p[1] - p[0] for p in pieces)
+    print(f"   🧬 指纹命中！复用 {format_timestamp(reused)} 的已有字幕，需补转 {len(gaps)} 段")
+
+    complete = True
+    if gaps:
+        from faster_whisper.audio import decode_audio
+        sr = model.feature_extractor.sampling_rate
+        audio = decode_audio(video_path, sampling_rate=sr)
+        for k, (g_start, g_end) in enumerate(gaps, start=1):
+            print(f"   🩹 补转第 {k}/{len(gaps)} 段: {format_timestamp(g_start)} -> {format_timestamp(g_end)}")
+            part_srt = f"{srt_path}.part{k}"
+            if not transcribe_with_strategy(model, audio[int(g_start * sr):int(g_end * sr)], part_srt, g_end - g_start):
+                complete = False
+            if not os.path.exists(part_srt):
+                continue
+            for line in read_srt(part_srt):
+                lines.append({"start": line["start"] + g_start, "end": line["end"] + g_start, "text": line["text"]})
+            os.remove(part_srt)
+        del audio
+
+    lines.sort(key=lambda l: l["start"])
+    write_srt(srt_path, lines)
+    print(f"   ✅ 拼接完成！共 {len(lines)} 行")
+    return complete
+
+
+# --- 📅 运行历史 & 夜跑计划 📅 ---
+def record_history(strategy, ext, duration, wall, outcome):
+    """追加一条运行记录 (写失败不影响转写)"""
+    if not duration:
+        return
+    record = {"time": time.time(), "strategy": strategy, "model": MODEL_SIZE, "device": DEVICE,
+              "compute_type": COMPUTE_TYPE, "ext": ext, "duration": round(duration, 2),
+              "wall": round(wall, 2), "outcome": outcome}
+    try:
+        with open(RUN_HISTORY_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"\n   ⚠️  运行历史写入失败: {e}")
+
+
+def load_history():
+    """只取当前 模型/设备/精度 下的记录，换了配置的历史没有参考价值"""
+    records = []
+    if not os.path.exists(RUN_HISTORY_PATH):
+        return records
+    with open(RUN_HISTORY_PATH, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                continue
+            if (r.get("model"), r.get("device"), r.get("compute_type")) == (MODEL_SIZE, DEVICE, COMPUTE_TYPE):
+                records.append(r)
+    return records
+
+
+def probe_duration(path):
+    """只读容器头拿时长，不解码；拿不到返回 None"""
+    try:
+        import av
+        with av.open(path) as container:
+            if container.duration:
+                return container.duration / av.time_base
+    except Exception:
+        pass
+    return None
+
+
+class ThroughputModel:
+    """根据历史记录估算：每种策略的耗时系数 (RTF) + 每种策略失败降级的概率"""
+
+    def __init__(self, records):
+        self.rtf = dict(DEFAULT_RTF)
+        for key in self.rtf:
+            # 出错的尝试往往几秒就挂了，算进耗时会把预估拉得过于乐观；它们只参与降级概率
+            ratios = sorted(r["wall"] / r["duration"] for r in records
+                            if r["strategy"] == key and r["duration"] > 0 and r["outcome"] in ("ok", "short"))
+            if ratios:
+                self.rtf[key] = ratios[len(ratios) // 2]
+        self.records = records
+        self.samples = len(records)
+
+    def retry_rate(self, strategy, ext):
+        """该策略失败 (转到下一级) 的概率；同扩展名样本够多就按扩展名算，Beta 先验平滑"""
+        tries = [r for r in self.records if r["strategy"] == strategy]
+        same_ext = [r for r in tries if r["ext"] == ext]
+        if len(same_ext) >= 5:
+            tries = same_ext
+        fails = sum(1 for r in tries if r["outcome"] != "ok")
+        return (fails + DEFAULT_RETRY_RATE * 2) / (len(tries) + 2)
+
+    def estimate(self, path, duration):
+        """返回 (预计秒数, 降级概率)"""
+        ext = os.path.splitext(path)[1].lower()
+        expected = self.rtf["probe"]
+        if ENABLE_FP_DEDUP:
+            # 每个文件都要先解码算指纹；命中去重后省下的转写时间这里不预测，按完整转写算 (偏保守)
+            expected += self.rtf["fingerprint"]
+        reach = 1.0
+        for attempt in range(1, MAX_RETRIES + 1):
+            key = STRATEGY_KEYS[attempt]
+            expected += reach * self.rtf[key]
+            if attempt < MAX_RETRIES:
+                reach *= self.retry_rate(key, ext)
+        return expected * duration, self.retry_rate(STRATEGY_KEYS[1], ext)
+
+
+def parse_args(argv):
+    """拆出 --开关 和路径；--deadline 8h 这种中间带空格的写法也认"""
+    flags, args = set(), []
+    it = iter(argv)
+    for arg in it:
+        if arg in ("--deadline", "--throttle-mbps"):
+            flags.add(f"{arg}={next(it, '')}")
+        elif arg.startswith("--"):
+            flags.add(arg)
+        else:
+            args.append(arg)
+    return flags, args
+
+
+def parse_budget(text):
+    """'8h' / '90m' / '3600' -> 秒"""
+    text = text.strip().lower()
+    units = {"h": 3600, "m": 60, "s": 1}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def build_plan(todo_list, budget=None):
+    """
+    枚举任务并估算耗时。有 budget 时按预计耗时从短到长排，塞满预算为止 (同样时间能做完最多的文件)。
+    返回 (计划 [(path, duration, est, p_retry)], 放不下的文件, 耗时模型)
+    """
+    throughput = ThroughputModel(load_history())
+    durations = [probe_duration(p) for p in todo_list]
+    known = sorted(d for d in durations if d)
+    fallback = known[len(known) // 2] if known else 3600
+
+    plan = []
+    for path, duration in zip(todo_list, durations):
+        est, p_retry = throughput.estimate(path, duration or fallback)
+        plan.append((path, duration, est, p_retry))
+
+    skipped = []
+    if budget is not None:
+        plan.sort(key=lambda item: item[2])
+        used = 0
+        kept = []
+        for item in plan:
+            if used + item[2] <= budget:
+                kept.append(item)
+                used += item[2]
+            else:
+                skipped.append(item)
+        plan = kept
+    return plan, skipped, throughput
+
+
+def print_plan(plan, skipped, throughput, budget=None):
+    print(f"📅 执行计划 ({len(plan)} 个文件, 参考 {throughput.samples} 条历史记录)")
+    rtf = ", ".join(f"{k}={v:.3f}" for k, v in throughput.rtf.items())
+    print(f"   耗时系数: {rtf}")
+    print("-" * 60)
+    now = time.time()
+    total = 0
+    for idx, (path, duration, est, p_retry) in enumerate(plan, start=1):
+        total += est
+        dur_text = format_timestamp(duration)[:8] if duration else "??:??:??"
+        finish = time.strftime("%H:%M", time.localtime(now + total))
+        print(f"{idx:3d}. {os.path.basename(path)}")
+        print(f"      时长 {dur_text} | 预计 {est / 60:5.1f} 分钟 | 降级概率 {p_retry * 100:3.0f}% | ~{finish} 完成")
+    print("-" * 60)
+    if ENABLE_FP_DEDUP:
+        print("   ℹ️  指纹去重能复用的文件不做预测，仍按完整转写估算，实际通常更快")
+    print(f"⏳ 总预计耗时: {format_timestamp(total)[:8]}，预计 {time.strftime('%m-%d %H:%M', time.localtime(now + total))} 跑完")
+    if budget is not None:
+        print(f"⏰ 时间预算: {format_timestamp(budget)[:8]}，放不下 {len(skipped)} 个文件:")
+        for path, _, est, _ in skipped:
+            print(f"      ⏭️  {os.path.basename(path)} (预计 {est / 60:.1f} 分钟)")
+        if skipped:
+            print("   放不下的文件排在最后，实际跑得比预计快的话还会按剩余时间继续尝试")
+
+
+def bench_word_alignment(model, video_path):
+    """
+    对比测试：老路径 (全程 word_timestamps=True) vs 按需对齐。
+    同样走策略1，打印两边耗时和切分后字幕的差异。
+    """
+    print(f"\n⏱️  对齐基准测试: {os.path.basename(video_path)}")
+
+    t0 = time.time()
+    segments, _ = run_transcribe(model, video_path, True, True, word_timestamps=True)
+    eager = [line for seg in segments for line in smart_split_segment(seg, MAX_CHARS_PER_LINE)]
+    eager_time = time.time() - t0
+    print(f"   全程对齐: {eager_time:.1f}s, {len(eager)} 行")
+
+    t0 = time.time()
+    segments, _ = run_transcribe(model, video_path, True, True)
+    aligner = LazyWordAligner(model, SharedAudio(video_path, model.feature_extractor.sampling_rate))
+    lazy = [line for seg, words in iter_aligned_segments(segments, aligner)
+            for line in smart_split_segment(seg, MAX_CHARS_PER_LINE, words)]
+    lazy_time = time.time() - t0
+    print(f"   按需对齐: {lazy_time:.1f}s, {len(lazy)} 行")
+
+    pairs = list(zip(eager, lazy))
+    same_text = sum(1 for a, b in pairs if a["text"] == b["text"])
+    max_shift = max((max(abs(a["start"] - b["start"]), abs(a["end"] - b["end"]))
+                     for a, b in pairs if a["text"] == b["text"]), default=0)
+    speedup = eager_time / lazy_time if lazy_time > 0 else 0
+    print(f"   🚀 加速比: {speedup:.2f}x")
+    print(f"   📝 文本一致: {same_text}/{max(len(eager), len(lazy))} 行, 时间轴最大偏差 {max_shift:.2f}s")
+
+
+# --- 📦 预取到本地 📦 ---
+class Prefetcher:
+    """
+    后台线程把接下来要处理的文件拉到本地临时目录 (只抽音轨或整文件复制)。
+    目录大小有上限，超了按 LRU 删掉没在用的旧文件；上次运行留下的缓存也会被复用。
+    read_limit (字节/秒) 用来模拟慢速 NAS：拿一个本地目录限速跑，就能验证预取效果。
+    限速时 ffmpeg 改为从 stdin 读由我们限速读出的数据；moov 在文件尾的 mp4 没法从管道抽音轨，会退回直接读原文件。
+    """
+
+    def __init__(self, root=PREFETCH_DIR, max_bytes=PREFETCH_MAX_BYTES, workers=PREFETCH_WORKERS,
+                 audio_only=PREFETCH_AUDIO_ONLY, read_limit=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.read_limit = read_limit
+        self.ffmpeg = shutil.which("ffmpeg") if audio_only else None
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()  # 本地路径 -> 字节数，越靠前越久没用
+        self.pinned = set()
+        self.futures = {}
+        self.local_of = {}
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+
+        os.makedirs(root, exist_ok=True)
+        leftovers = [os.path.join(root, name) for name in os.listdir(root)]
+        for path in sorted(leftovers, key=os.path.getmtime):
+            if path.endswith(".part"):
+                os.remove(path)
+            else:
+                self.cache[path] = os.path.getsize(path)
+
+    def _local_name(self, path):
+        stat = os.stat(path)
+        key = hashlib.md5(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime}".encode("utf-8")).hexdigest()
+        ext = ".mka" if self.ffmpeg else os.path.splitext(path)[1]
+        return os.path.join(self.root, key + ext)
+
+    def schedule(self, paths):
+        with self.lock:
+            for path in paths:
+                future = self.futures.get(path)
+                # 之前因为空间被占满没拉成 (结果是 None) 的，现在可能已经腾出地方了，重新排队
+                if future is None or (future.done() and not future.exception() and future.result() is None):
+                    self.futures[path] = self.pool.submit(self._fetch, path)
+
+    def get(self, path):
+        """等预取完成，返回本地路径；预取失败或实在放不下返回 None (直接读原文件)"""
+        self.schedule([path])
+        if not self.futures[path].done():
+            print("   📦 等待预取完成...", flush=True)
+        try:
+            local = self.futures[path].result()
+            if local is None:
+                # 排队时空间被前面的文件占着，前面的用完已经释放了，当场再试一次
+                self.schedule([path])
+                local = self.futures[path].result()
+            return local
+        except Exception as e:
+            print(f"   ⚠️  预取失败，直接读原文件: {e}")
+            return None
+
+    def release(self, path):
+        with self.lock:
+            self.futures.pop(path, None)
+            self.pinned.discard(self.local_of.pop(path, None))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def _make_room(self, size):
+        """按 LRU 删没在用的文件直到能再放下 size 字节 (调用方持锁)；删完还不够返回 False"""
+        while sum(self.cache.values()) + size > self.max_bytes:
+            victim = next((p for p in self.cache if p not in self.pinned), None)
+            if victim is None:
+                return False
+            self.cache.pop(victim)
+            try:
+                os.remove(victim)
+            except OSError:
+                pass
+        return True
+
+    def _reserve(self, local, size):
+        """腾出空间并占位；被占用的文件全删完还不够就放弃"""
+        with self.lock:
+            if size > self.max_bytes or not self._make_room(size):
+                return False
+            self.cache[local] = size
+            self.pinned.add(local)
+            return True
+
+    def _estimate_size(self, path):
+        """预计落到本地的大小：整文件复制就是原大小；只抽音轨按 时长 x 音频码率 估算"""
+        size = os.path.getsize(path)
+        if not self.ffmpeg:
+            return size
+        try:
+            import av
+            with av.open(path) as container:
+                duration = container.duration / av.time_base if container.duration else None
+                bit_rate = container.streams.audio[0].bit_rate if container.streams.audio else None
+        except Exception:
+            return size
+        if not duration:
+            return size
+        bit_rate = bit_rate or PREFETCH_AUDIO_KBPS * 1000
+        # 留 10% 给封装开销
+        return min(size, int(duration * bit_rate / 8 * 1.1))
+
+    def _fetch(self, path):
+        local = self._local_name(path)
+        with self.lock:
+            if local in self.cache and local not in self.pinned:
+                self.cache.move_to_end(local)
+                self.pinned.add(local)
+                self.local_of[path] = local
+                return local
+
+        # 按预计大小占位，完成后再按实际大小修正
+        if not self._reserve(local, self._estimate_size(path)):
+            return None
+        self.local_of[path] = local
+
+        tmp = local + ".part"
+        try:
+            if self.ffmpeg:
+                self._extract_audio(path, tmp)
+            else:
+                self._copy(path, tmp)
+            os.replace(tmp, local)
+        except Exception:
+            if os.path.exists(tmp): os.remove(tmp)
+            with self.lock:
+                self.cache.pop(local, None)
+                self.pinned.discard(local)
+                self.local_of.pop(path, None)
+            raise
+
+        with self.lock:
+            # 按实际大小重新记账；比估的大就再腾一次空间 (腾不出来也先留着，下一个文件占位时会再挤)
+            actual = os.path.getsize(local)
+            self.cache.pop(local, None)
+            self._make_room(actual)
+            self.cache[local] = actual
+        return local
+
+    def _extract_audio(self, src, dst):
+        output = ["-map", "0:a:0", "-vn", "-c:a", "copy", "-f", "matroska", dst]
+        if not self.read_limit:
+            cmd = [self.ffmpeg, "-nostdin", "-v", "error", "-y", "-i", src] + output
+            result = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="replace")
+            if result.returncode != 0:
+                raise RuntimeError(f"ffmpeg 抽音轨失败: {result.stderr.strip()[-200:]}")
+            return
+
+        # 模拟慢速 NAS：源文件由我们限速读出来喂给 ffmpeg
+        cmd = [self.ffmpeg, "-v", "error", "-y", "-i", "pipe:0"] + output
+        with tempfile.TemporaryFile() as err:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=err)
+            try:
+                for chunk in self._read_chunks(src):
+                    proc.stdin.write(chunk)
+            except BrokenPipeError:
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            returncode = proc.wait()
+            err.seek(0)
+            message = err.read().decode("utf-8", errors="replace").strip()
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg 抽音轨失败: {message[-200:]}")
+
+    def _copy(self, src, dst):
+        with open(dst, "wb") as fout:
+            for chunk in self._read_chunks(src):
+                fout.write(chunk)
+
+    def _read_chunks(self, src):
+        """大块顺序读源文件；设置了 read_limit 就按这个速度限流"""
+        start = time.time()
+        done = 0
+        with open(src, "rb", buffering=0) as fin:
+            while True:
+                chunk = fin.read(PREFETCH_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+                done += len(chunk)
+                if self.read_limit:
+                    ahead = done / self.read_limit - (time.time() - start)
+                    if ahead > 0: time.sleep(ahead)
+
+
+# --- 👷 子进程转写 & 回收 👷 ---
+def current_rss_mb():
+    """当前进程常驻内存 (MB)：优先 psutil，没装就走 Windows API / Linux /proc；都不行返回 None"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 1024 ** 2
+    except ImportError:
+        pass
+    if os.name == "nt":
+        return _windows_rss_mb()
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _windows_rss_mb():
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    try:
+        kernel32 = ctypes.WinDLL("kernel32")
+        psapi = ctypes.WinDLL("psapi")
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS),
+                                               wintypes.DWORD]
+        psapi.GetProcessMemoryInfo.restype = wintypes.BOOL
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize / 1024 ** 2
+    except (OSError, AttributeError):
+        pass
+    return None
+
+
+def current_vram_mb():
+    """
+    整张显卡已用显存 (MB)。GeForce 在 WDDM 下按进程查显存只会显示 N/A，
+    所以直接看整卡用量：同一时间只有一个转写子进程，整卡用量足够当代理指标。
+    查不到 (没装驱动 / 没有 nvidia-smi) 返回 None。
+    """
+    try:
+        out = subprocess.run(["nvidia-smi", "-i", "0", "--query-gpu=memory.used",
+                              "--format=csv,noheader,nounits"],
+                             capture_output=True, text=True, timeout=10).stdout
+        return float(out.strip().splitlines()[0])
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return None
+
+
+def resolve_model_path():
+    """在主进程里把模型下载/定位到本地一次，子进程只从本地目录加载"""
+    if os.path.isdir(MODEL_SIZE):
+        return MODEL_SIZE
+    from faster_whisper.utils import download_model
+    return download_model(MODEL_SIZE, cache_dir=MODEL_CACHE_DIR)
+
+
+def worker_main(model_path, task_q, result_q):
+    """子进程入口：加载一次模型，然后一个接一个处理主进程发来的文件"""
+    try:
+        model = WhisperModel(model_path, device=DEVICE, compute_type=COMPUTE_TYPE)
+    except Exception as e:
+        result_q.put(("error", str(e)))
+        return
+    fp_index = FingerprintIndex() if ENABLE_FP_DEDUP else None
+    result_q.put(("ready", os.getpid()))
+
+    while True:
+        task = task_q.get()
+        if task is None:
+            break
+        video_path, file_idx, total_files, local_path = task
+        process_one_video(model, video_path, file_idx, total_files, fp_index, local_path)
+        gc.collect()
+        result_q.put(("done", video_path, current_rss_mb(), current_vram_mb()))
+
+
+class WorkerSupervisor:
+    """
+    主进程这边的看门人：同一时间只有一个转写子进程。
+    处理满 WORKER_MAX_FILES 个文件或内存/显存超标就让它退出、下次用新进程；
+    子进程中途挂掉、或者按音频时长算的时限内没处理完 (强杀) 时 run() 返回 False，
+    由调用方决定要不要换新进程重试。
+    """
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.ctx = multiprocessing.get_context("spawn")
+        self.proc = None
+        self.files_done = 0
+        self.warned = set()
+
+    def start(self):
+        self.task_q = self.ctx.Queue()
+        self.result_q = self.ctx.Queue()
+        self.proc = self.ctx.Process(target=worker_main, args=(self.model_path, self.task_q, self.result_q),
+                                     daemon=True)
+        self.proc.start()
+        self.files_done = 0
+        msg = self._wait(WORKER_START_TIMEOUT)
+        if msg is None or msg[0] != "ready":
+            self.stop()
+            raise RuntimeError(msg[1] if msg else "子进程启动失败")
+
+    def _wait(self, timeout):
+        """等子进程回消息；进程死了或超时 (超时会强杀子进程) 返回 None"""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return self.result_q.get(timeout=1)
+            except queue.Empty:
+                if not self.proc.is_alive():
+                    try:
+                        return self.result_q.get_nowait()
+                    except queue.Empty:
+                        return None
+                if time.time() > deadline:
+                    print(f"\n⏱️  转写子进程 {timeout / 60:.0f} 分钟没有回应，强制结束")
+                    self.proc.terminate()
+                    self.proc.join(timeout=10)
+                    if self.proc.is_alive():
+                        self.proc.kill()
+                        self.proc.join()
+                    return None
+
+    def run(self, video_path, file_idx, total_files, local_path=None, duration=None):
+        if self.proc is None:
+            print("\n♻️  启动新的转写子进程 (从本地缓存加载模型)...")
+            self.start()
+        self.task_q.put((video_path, file_idx, total_files, local_path))
+        timeout = max(WORKER_TIMEOUT_MIN, duration * WORKER_TIMEOUT_RTF) if duration else WORKER_TIMEOUT_FALLBACK
+        msg = self._wait(timeout)
+        if msg is None:
+            print(f"\n💥 转写子进程崩溃或超时 (退出码 {self.proc.exitcode})")
+            self.proc.join(timeout=5)
+            self.proc = None
+            return False
+
+        _, _, rss, vram = msg
+        self.files_done += 1
+        # 读不到的指标只提示一次：对应的回收条件不会生效，只剩按文件数回收
+        if rss is None and "rss" not in self.warned:
+            self.warned.add("rss")
+            print("   ⚠️  读不到子进程内存占用 (可以 pip install psutil)，内存超标回收不生效")
+        if vram is None and "vram" not in self.warned:
+            self.warned.add("vram")
+            print("   ⚠️  nvidia-smi 读不到显存用量，显存超标回收不生效")
+        reason = None
+        if self.files_done >= WORKER_MAX_FILES:
+            reason = f"已处理 {self.files_done} 个文件"
+        elif rss is not None and rss > WORKER_MAX_RSS_MB:
+            reason = f"内存 {rss:.0f}MB 超标"
+        elif vram is not None and vram > WORKER_MAX_VRAM_MB:
+            reason = f"显存 {vram:.0f}MB 超标"
+        if reason:
+            print(f"   ♻️  回收转写子进程: {reason}")
+            self.stop()
+        return True
+
+    def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.is_alive():
+            self.task_q.put(None)
+            self.proc.join(timeout=30)
+            if self.proc.is_alive():
+                self.proc.terminate()
+                self.proc.join()
+        self.proc = None
+
+
+def process_one_video(model, video_path, file_idx, total_files, fp_index=None, local_path=None):
     filename = os.path.basename(video_path)
     output_dir = os.path.dirname(video_path)
     filename_no_ext = os.path.splitext(filename)[0]
@@ -229,16 +1472,37 @@ def process_one_video(model, video_path, file_idx, total_files):
 
     print(f"\n🎬 [{file_idx}/{total_files}] 正在处理: {filename}")
 
+    # 预取过就读本地副本，字幕和指纹库仍然按原路径记
+    source = local_path or video_path
+    source_ext = os.path.splitext(video_path)[1].lower()
+
     try:
+        fp = None
+        if fp_index is not None:
+            print("   🧬 计算音频指纹...", end="", flush=True)
+            fp, fp_duration = fp_index.fingerprint(video_path, source)
+            pieces = fp_index.find_coverage(fp, video_path)
+            print(f" -> {len(fp)} 帧, {len(pieces)} 处重合")
+            if pieces:
+                if transcribe_with_reuse(model, source, srt_path, fp_duration, pieces):
+                    fp_index.register(video_path, fp, fp_duration, srt_path)
+                return
+
         # 获取时长 (不使用 pipeline，使用原生 model 快速探测)
         print("   🔍 分析视频时长...", end="", flush=True)
-        _, info = model.transcribe(video_path, beam_size=1, temperature=0, no_speech_threshold=1.0,
+        probe_start = time.time()
+        _, info = model.transcribe(source, beam_size=1, temperature=0, no_speech_threshold=1.0,
                                    condition_on_previous_text=False)
         total_duration = info.duration
+        record_history("probe", source_ext, total_duration, time.time() - probe_start, "ok")
         print(f" -> {format_timestamp(total_duration)}")
 
         # 核心逻辑
-        transcribe_with_strategy(model, video_path, srt_path, total_duration)
+        complete = transcribe_with_strategy(model, source, srt_path, total_duration, source_ext)
+
+        # 只有完整的字幕才能登记进指纹库，残缺的拿去给别的副本复用会把缺口一起复制过去
+        if fp is not None and complete:
+            fp_index.register(video_path, fp, total_duration, srt_path)
 
     except Exception as e:
         print(f"\n   ❌ 预处理失败: {e}")
@@ -246,11 +1510,21 @@ def process_one_video(model, video_path, file_idx, total_files):
 
 def main():
     os.system('cls' if os.name == 'nt' else 'clear')
-    if len(sys.argv) < 2:
+    flags, args = parse_args(sys.argv[1:])
+    if not args:
         print("❌ 请拖拽文件！")
         return
 
-    input_path = sys.argv[1]
+    input_path = args[0]
+    budget = None
+    for flag in flags:
+        if flag.startswith("--deadline="):
+            value = flag.split("=", 1)[1]
+            try:
+                budget = parse_budget(value)
+            except ValueError:
+                print(f"❌ 时间预算看不懂: '{value}'，示例: --deadline=8h / --deadline 90m / --deadline=3600")
+                return
     todo_list = []
     if os.path.isfile(input_path):
         if is_video_file(input_path): todo_list.append(input_path)
@@ -259,17 +1533,85 @@ def main():
             for file in files:
                 if is_video_file(file): todo_list.append(os.path.join(root, file))
 
+    if "--plan" in flags or budget is not None:
+        plan, skipped, throughput = build_plan(todo_list, budget)
+        print_plan(plan, skipped, throughput, budget)
+        if "--plan" in flags:
+            return
+        # 放不下的排在后面：前面跑得比预计快的话，运行时的预算检查还会放它们进来
+        todo_list = [item[0] for item in plan + skipped]
+        estimates = {item[0]: item[2] for item in plan + skipped}
+
+    if "--bench-align" in flags:
+        model = WhisperModel(MODEL_SIZE, device=DEVICE, compute_type=COMPUTE_TYPE)
+        for video_path in todo_list:
+            bench_word_alignment(model, video_path)
+        return
+
     print(f"🔥 正在加载 RTX 5080 引擎 (ASMR 智能版)...")
     try:
-        # 这里只加载基础模型，BatchPipeline 在策略1里动态创建
-        model = WhisperModel(MODEL_SIZE, device="cuda", compute_type="float16")
+        # 模型在子进程里加载，主进程只负责调度、预取和记账
+        supervisor = WorkerSupervisor(resolve_model_path())
+        supervisor.start()
     except Exception as e:
         print(f"❌ 显卡报错: {e}")
         return
 
+    prefetcher = None
+    if ENABLE_PREFETCH or "--prefetch" in flags:
+        read_limit = None
+        for flag in flags:
+            if flag.startswith("--throttle-mbps="):
+                value = flag.split("=", 1)[1]
+                try:
+                    read_limit = float(value) * 1024 * 1024
+                except ValueError:
+                    print(f"❌ 限速看不懂: '{value}'，示例: --throttle-mbps=50")
+                    return
+        prefetcher = Prefetcher(read_limit=read_limit)
+        print(f"📦 预取已开启: 提前 {PREFETCH_AHEAD} 个文件 -> {PREFETCH_DIR}")
+
+    file_state = {}
+    deferred = []
+    run_start = time.time()
     for idx, video_path in enumerate(todo_list, start=1):
-        process_one_video(model, video_path, idx, len(todo_list))
-        gc.collect()
+        if budget is not None and time.time() - run_start + estimates[video_path] > budget:
+            # 放不下就记下来跳过 (前面跑得比预计快时，原本排不进计划的文件也会在这里被放行)
+            deferred.append(video_path)
+            continue
+        local_path = None
+        if prefetcher:
+            prefetcher.schedule(todo_list[idx - 1:idx + PREFETCH_AHEAD])
+            local_path = prefetcher.get(video_path)
+
+        # 每个文件的状态记在主进程：子进程崩了就换新进程重试，再崩就跳过，不拖垮整批
+        file_state[video_path] = "failed"
+        duration = probe_duration(local_path or video_path)
+        for crash in range(WORKER_CRASH_RETRIES + 1):
+            try:
+                if supervisor.run(video_path, idx, len(todo_list), local_path, duration):
+                    file_state[video_path] = "done"
+                    break
+            except Exception as e:
+                print(f"❌ 子进程启动失败: {e}")
+                break
+            if crash < WORKER_CRASH_RETRIES:
+                print(f"   🔁 在新的子进程上重试: {os.path.basename(video_path)}")
+        if prefetcher: prefetcher.release(video_path)
+
+    supervisor.stop()
+    if prefetcher: prefetcher.shutdown()
+
+    if deferred:
+        print(f"\n⏰ 时间预算不够，{len(deferred)} 个文件留到下次:")
+        for path in deferred:
+            print(f"   - {path}")
+
+    failed = [path for path, state in file_state.items() if state == "failed"]
+    if failed:
+        print(f"\n💀 {len(failed)} 个文件子进程连续崩溃/超时，已跳过:")
+        for path in failed:
+            print(f"   - {path}")
 
     print(f"\n🏆 全部完成！")
 